@@ -2,13 +2,16 @@
 # See LICENSE file for licensing details.
 
 """Common logic for both k8s and machine charms for Grafana Agent."""
+import hashlib
+import json
 import logging
 import os
 import pathlib
 import re
 import shutil
 from collections import namedtuple
-from typing import Any, Callable, Dict, Optional, Union
+from functools import cached_property
+from typing import Any, Callable, Dict, List, Optional, Union
 
 import yaml
 from charms.loki_k8s.v0.loki_push_api import LokiPushApiConsumer, LokiPushApiProvider
@@ -20,12 +23,26 @@ from charms.prometheus_k8s.v0.prometheus_remote_write import (
     PrometheusRemoteWriteConsumer,
 )
 from charms.prometheus_k8s.v0.prometheus_scrape import MetricsEndpointConsumer
-from ops.charm import CharmBase, RelationChangedEvent
+from ops.charm import CharmBase, RelationChangedEvent, UpgradeCharmEvent
+from ops.framework import StoredState
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
 from ops.pebble import APIError, PathError
-from requests import Session
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+
+try:
+    # Prefer the libyaml bindings, which are much faster than the pure-python implementation
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper, SafeLoader  # type: ignore
+
+
+class NoAliasSafeDumper(SafeDumper):
+    """Safe dumper which writes out shared objects in full instead of as YAML aliases."""
+
+    def ignore_aliases(self, data):
+        """Never emit anchors and aliases."""
+        return True
+
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +54,25 @@ METRICS_RULES_DEST_PATH = "./prometheus_alert_rules"
 REMOTE_WRITE_RELATION_NAME = "send-remote-write"
 SCRAPE_RELATION_NAME = "metrics-endpoint"
 
+# Output of `agent -version` looks like this:
+# agent, version v0.26.1 (branch: HEAD, revision: 2b88be37)
+_AGENT_VERSION_RE = re.compile(r"v(\d+\.\d+\.\d+)")
+
+# Labels set on the agent's own metrics, as (target_label, source_labels) pairs.
+# Labels without source labels overwrite whatever value the label had.
+_SELF_MONITORING_RELABEL_SCHEMA = (
+    # Align the "job" name with those of prometheus_scrape
+    ("job", None),
+    # Align the "instance" label with the rest of the Juju-collected metrics
+    ("instance", None),
+    # To add a label, we create a relabelling that replaces a built-in
+    ("juju_charm", ("__address__",)),
+    ("juju_model", ("__address__",)),
+    ("juju_model_uuid", ("__address__",)),
+    ("juju_application", ("__address__",)),
+    ("juju_unit", ("__address__",)),
+)
+
 RulesMapping = namedtuple("RulesMapping", ["src", "dest"])
 
 
@@ -51,11 +87,27 @@ class GrafanaAgentReloadError(Exception):
 class GrafanaAgentCharm(CharmBase):
     """Grafana Agent Charm."""
 
+    _stored = StoredState()
     _name = "agent"
     _promtail_positions = "/tmp/positions.yaml"
     _http_listen_port = 3500
     _grpc_listen_port = 3600
 
+    # Static parts of the logs config, shared by every render. They are never mutated, and
+    # the config is dumped without aliases, so sharing them is safe.
+    _promtail_positions_config = {"filename": _promtail_positions}
+    _loki_scrape_configs = [
+        {
+            "job_name": "loki",
+            "loki_push_api": {
+                "server": {
+                    "http_listen_port": _http_listen_port,
+                    "grpc_listen_port": _grpc_listen_port,
+                },
+            },
+        }
+    ]
+
     def __init__(self, *args):
         super().__init__(*args)
 
@@ -68,6 +120,9 @@ class GrafanaAgentCharm(CharmBase):
             dest=os.path.join(self.charm_dir, METRICS_RULES_DEST_PATH),
         )
 
+        # Fingerprint and modification time of the config last written to CONFIG_PATH
+        self._stored.set_default(config_hash=None, config_mtime=None)
+
         self.service_patch = KubernetesServicePatch(
             self,
             [
@@ -143,6 +198,14 @@ class GrafanaAgentCharm(CharmBase):
         """
         raise NotImplementedError("Please override the write_file method")
 
+    def file_mtime(self, filepath: Union[str, pathlib.Path]) -> Optional[float]:
+        """Get a file's last modification time.
+
+        Returns:
+            The modification time as a POSIX timestamp, or None if the file does not exist
+        """
+        raise NotImplementedError("Please override the file_mtime method")
+
     def restart(self) -> None:
         """Restart grafana agent."""
         raise NotImplementedError("Please override the restart method")
@@ -166,9 +229,13 @@ class GrafanaAgentCharm(CharmBase):
         )
 
     def update_alerts_rules(
-        self, _, alerts_func: Any, reload_func: Callable, mapping: RulesMapping
+        self, event, alerts_func: Any, reload_func: Callable, mapping: RulesMapping
     ):
-        """Copy alert rules from relations and save them to disk."""
+        """Copy alert rules from relations and save them to disk.
+
+        Only the rule files whose contents changed are rewritten. The bundled rules are
+        copied over again on upgrades, as they may have changed with the charm.
+        """
         rules = {}
 
         # MetricsEndpointConsumer.alerts is not @property, but Loki is, so
@@ -178,12 +245,32 @@ class GrafanaAgentCharm(CharmBase):
         else:
             rules = alerts_func
 
-        shutil.rmtree(mapping.dest)
-        shutil.copytree(mapping.src, mapping.dest)
+        if isinstance(event, UpgradeCharmEvent) or not os.path.isdir(mapping.dest):
+            # The bundled rules may have changed with the charm, so start afresh
+            shutil.rmtree(mapping.dest, ignore_errors=True)
+            shutil.copytree(mapping.src, mapping.dest)
+
+        rule_files = set()
         for topology_identifier, rule in rules.items():
             file_handle = pathlib.Path(mapping.dest, "juju_{}.rules".format(topology_identifier))
-            file_handle.write_text(yaml.dump(rule))
+            rule_files.add(file_handle.name)
+            text = yaml.dump(rule, Dumper=SafeDumper)
+            if file_handle.is_file() and file_handle.read_text() == text:
+                continue
+            file_handle.write_text(text)
             logger.debug("updated alert rules file {}".format(file_handle.absolute()))
+
+        # Drop the rules of relations which are gone
+        with os.scandir(mapping.dest) as entries:
+            for entry in entries:
+                if (
+                    entry.is_file()
+                    and entry.name.startswith("juju_")
+                    and entry.name.endswith(".rules")
+                    and entry.name not in rule_files
+                ):
+                    os.remove(entry.path)
+                    logger.debug("removed alert rules file {}".format(entry.path))
         reload_func()
 
     def _on_loki_push_api_endpoint_joined(self, event) -> None:
@@ -206,10 +293,10 @@ class GrafanaAgentCharm(CharmBase):
 
     def _update_status(self) -> None:
         """Update the status to reflect the status quo."""
-        if len(self.model.relations["metrics-endpoint"]):
-            if not len(self.model.relations[REMOTE_WRITE_RELATION_NAME]):
-                self.unit.status = WaitingStatus("no related Prometheus remote-write")
-                return
+        relations = self.model.relations
+        if relations[SCRAPE_RELATION_NAME] and not relations[REMOTE_WRITE_RELATION_NAME]:
+            self.unit.status = WaitingStatus("no related Prometheus remote-write")
+            return
 
         if not self.is_ready():
             self.unit.status = WaitingStatus("waiting for the agent to start")
@@ -224,10 +311,20 @@ class GrafanaAgentCharm(CharmBase):
             return
 
         config = self._config_file()
-        old_config = None
+        # JSON is much cheaper to produce than YAML, so fingerprint the config with it
+        config_hash = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+        mtime = self.file_mtime(CONFIG_PATH)
+        if (
+            mtime is not None
+            and mtime == self._stored.config_mtime
+            and config_hash == self._stored.config_hash
+        ):
+            # The file on disk is still the one written for this very config
+            return
 
+        old_config = None
         try:
-            old_config = yaml.safe_load(self.read_file(CONFIG_PATH))
+            old_config = yaml.load(self.read_file(CONFIG_PATH), Loader=SafeLoader)
         except (FileNotFoundError, PathError):
             # If the file does not yet exist, pebble_ready has not run yet,
             # and we may be processing a deferred event
@@ -235,11 +332,14 @@ class GrafanaAgentCharm(CharmBase):
 
         try:
             if config != old_config:
-                self.write_file(CONFIG_PATH, yaml.dump(config))
+                self.write_file(CONFIG_PATH, yaml.dump(config, Dumper=NoAliasSafeDumper))
+                mtime = self.file_mtime(CONFIG_PATH)
                 # FIXME: change this to self._reload_config when #19 is fixed
                 # Restart the service to pick up the new config
                 self.restart()
                 self.unit.status = ActiveStatus()
+            self._stored.config_hash = config_hash
+            self._stored.config_mtime = mtime
         except GrafanaAgentReloadError as e:
             self.unit.status = BlockedStatus(str(e))
         except APIError as e:
@@ -259,11 +359,15 @@ class GrafanaAgentCharm(CharmBase):
         Returns:
             A yaml string with grafana agent config
         """
+        # Each of these walks the relation data, so only fetch them once
+        remote_write_endpoints = self._remote_write.endpoints
+        loki_endpoints = self._loki_consumer.loki_endpoints
+
         config = {}
         config.update(self._server_config())
-        config.update(self._integrations_config())
-        config.update(self._prometheus_config())
-        config.update(self._loki_config())
+        config.update(self._integrations_config(remote_write_endpoints))
+        config.update(self._prometheus_config(remote_write_endpoints))
+        config.update(self._loki_config(loki_endpoints))
         return config
 
     def _server_config(self) -> dict:
@@ -274,71 +378,85 @@ class GrafanaAgentCharm(CharmBase):
         """
         return {"server": {"log_level": "info"}}
 
-    def _integrations_config(self) -> dict:
-        """Return the integrations section of the config.
+    @cached_property
+    def _topology(self) -> Dict[str, str]:
+        """Return the Juju topology of this unit.
+
+        The topology does not change during the lifetime of the unit, so it is only
+        looked up once.
 
         Returns:
-            The dict representing the config
+            A dict mapping the topology labels to their values
         """
-        juju_model = self.model.name
-        juju_model_uuid = self.model.uuid
-        juju_application = self.model.app.name
-        juju_unit = self.unit.name
+        return {
+            "juju_model": self.model.name,
+            "juju_model_uuid": self.model.uuid,
+            "juju_application": self.model.app.name,
+            "juju_unit": self.unit.name,
+        }
 
-        job_name = f"juju_{juju_model}_{juju_model_uuid}_{juju_application}_self-monitoring"
-        instance_value = f"{juju_model}_{juju_model_uuid}_{juju_application}_{juju_unit}"
+    @cached_property
+    def _instance_name(self) -> str:
+        """Return the value of the "instance" label for this unit.
 
+        Returns:
+            The topology values joined by underscores
+        """
+        return "_".join(self._topology.values())
+
+    def _integrations_config(self, remote_write_endpoints: List[dict]) -> dict:
+        """Return the integrations section of the config.
+
+        Args:
+            remote_write_endpoints: the Prometheus remote-write endpoints to push to
+
+        Returns:
+            The dict representing the config
+        """
         return {
             "integrations": {
                 "agent": {
                     "enabled": True,
-                    "relabel_configs": [
-                        # Align the "job" name with those of prometheus_scrape
-                        {
-                            "target_label": "job",
-                            "regex": "(.*)",
-                            "replacement": job_name,
-                        },
-                        # Align the "instance" label with the rest of the Juju-collected metrics
-                        {
-                            "target_label": "instance",
-                            "regex": "(.*)",
-                            "replacement": instance_value,
-                        },
-                        {  # To add a label, we create a relabelling that replaces a built-in
-                            "source_labels": ["__address__"],
-                            "target_label": "juju_charm",
-                            "replacement": self.meta.name,
-                        },
-                        {  # To add a label, we create a relabelling that replaces a built-in
-                            "source_labels": ["__address__"],
-                            "target_label": "juju_model",
-                            "replacement": juju_model,
-                        },
-                        {
-                            "source_labels": ["__address__"],
-                            "target_label": "juju_model_uuid",
-                            "replacement": juju_model_uuid,
-                        },
-                        {
-                            "source_labels": ["__address__"],
-                            "target_label": "juju_application",
-                            "replacement": juju_application,
-                        },
-                        {
-                            "source_labels": ["__address__"],
-                            "target_label": "juju_unit",
-                            "replacement": juju_unit,
-                        },
-                    ],
+                    "relabel_configs": self._relabel_configs(),
                 },
-                "prometheus_remote_write": self._remote_write.endpoints,
+                "prometheus_remote_write": remote_write_endpoints,
             }
         }
 
-    def _prometheus_config(self) -> dict:
+    def _relabel_configs(self) -> List[dict]:
+        """Return the relabel configs attaching this unit's Juju topology to its own metrics.
+
+        Returns:
+            A list of relabel configs
+        """
+        topology = self._topology
+        job_name = "juju_{}_{}_{}_self-monitoring".format(
+            topology["juju_model"], topology["juju_model_uuid"], topology["juju_application"]
+        )
+
+        replacements = dict(
+            topology, job=job_name, instance=self._instance_name, juju_charm=self.meta.name
+        )
+
+        return [
+            (
+                {"target_label": label, "regex": "(.*)", "replacement": replacements[label]}
+                if source_labels is None
+                else {
+                    "source_labels": list(source_labels),
+                    "target_label": label,
+                    "replacement": replacements[label],
+                }
+            )
+            for label, source_labels in _SELF_MONITORING_RELABEL_SCHEMA
+        ]
+
+    def _prometheus_config(self, remote_write_endpoints: List[dict]) -> dict:
         """Return the prometheus section of the config.
 
+        Args:
+            remote_write_endpoints: the Prometheus remote-write endpoints to push to
+
         Returns:
             The dict representing the config
         """
@@ -349,19 +467,22 @@ class GrafanaAgentCharm(CharmBase):
                     {
                         "name": "agent_scraper",
                         "scrape_configs": self._scrape.jobs(),
-                        "remote_write": self._remote_write.endpoints,
+                        "remote_write": remote_write_endpoints,
                     }
                 ],
             }
         }
 
-    def _loki_config(self) -> dict:
+    def _loki_config(self, loki_endpoints: List[dict]) -> dict:
         """Modifies the loki section of the config.
 
+        Args:
+            loki_endpoints: the Loki push API endpoints to send logs to
+
         Returns:
             a dict with Loki config
         """
-        if not self._loki_consumer.loki_endpoints:
+        if not loki_endpoints:
             return {"logs": {}}
 
         return {
@@ -369,19 +490,9 @@ class GrafanaAgentCharm(CharmBase):
                 "configs": [
                     {
                         "name": "promtail",
-                        "clients": self._loki_consumer.loki_endpoints,
-                        "positions": {"filename": f"{self._promtail_positions}"},
-                        "scrape_configs": [
-                            {
-                                "job_name": "loki",
-                                "loki_push_api": {
-                                    "server": {
-                                        "http_listen_port": self._http_listen_port,
-                                        "grpc_listen_port": self._grpc_listen_port,
-                                    },
-                                },
-                            }
-                        ],
+                        "clients": loki_endpoints,
+                        "positions": self._promtail_positions_config,
+                        "scrape_configs": self._loki_scrape_configs,
                     }
                 ]
             }
@@ -396,6 +507,11 @@ class GrafanaAgentCharm(CharmBase):
         Raises:
             GrafanaAgentReloadError: if configuration could not be reloaded.
         """
+        # Imported here as requests is slow to import and only needed for reloads
+        from requests import Session
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
         try:
             self.unit.status = MaintenanceStatus("reloading agent configuration")
             url = "http://localhost/-/reload"
@@ -417,10 +533,7 @@ class GrafanaAgentCharm(CharmBase):
         """
         if not self.is_ready():
             return None
-        version_output = self.agent_version_output()
-        # Output looks like this:
-        # agent, version v0.26.1 (branch: HEAD, revision: 2b88be37)
-        result = re.search(r"v(\d*\.\d*\.\d*)", version_output)
+        result = _AGENT_VERSION_RE.search(self.agent_version_output())
         if result is None:
             return result
         return result.group(1)
@@ -6,12 +6,13 @@
 """A  juju charm for Grafana Agent on Kubernetes."""
 import logging
 import pathlib
-from typing import Union
+from typing import Optional, Union
 
 import yaml
 from ops.main import main
+from ops.pebble import APIError
 
-from grafana_agent import CONFIG_PATH, GrafanaAgentCharm
+from grafana_agent import CONFIG_PATH, GrafanaAgentCharm, NoAliasSafeDumper
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +31,9 @@ class GrafanaAgentK8sCharm(GrafanaAgentCharm):
         Args:
             event: The event object of the pebble ready event
         """
-        self._container.push(CONFIG_PATH, yaml.dump(self._config_file()), make_dirs=True)
+        self._container.push(
+            CONFIG_PATH, yaml.dump(self._config_file(), Dumper=NoAliasSafeDumper), make_dirs=True
+        )
 
         pebble_layer = {
             "summary": "agent layer",
@@ -85,6 +88,18 @@ class GrafanaAgentK8sCharm(GrafanaAgentCharm):
         """
         self._container.push(path, text)
 
+    def file_mtime(self, filepath: Union[str, pathlib.Path]) -> Optional[float]:
+        """Get a file's last modification time.
+
+        Returns:
+            The modification time as a POSIX timestamp, or None if the file does not exist
+        """
+        try:
+            files = self._container.list_files(filepath, itself=True)
+        except APIError:
+            return None
+        return files[0].last_modified.timestamp() if files else None
+
     def restart(self) -> None:
         """Restart grafana agent."""
         self._container.restart("agent")
@@ -184,6 +184,21 @@ class TestPrometheusRules(TestAlertIngestion):
         else:
             assert False  # Could not find the correct alert rule to check
 
+    def test_only_changed_rule_files_are_rewritten(self):
+        charm = self.harness.charm
+        rules = {"lma_f2c1b2a6_provider-tester": PROMETHEUS_ALERT_RULES}
+        rule_file = pathlib.Path(self.metrics_path.dest, "juju_lma_f2c1b2a6_provider-tester.rules")
+
+        charm.update_alerts_rules(None, rules, lambda: None, self.metrics_path)
+        self.assertTrue(rule_file.is_file())
+
+        with patch.object(pathlib.Path, "write_text") as write_text:
+            charm.update_alerts_rules(None, rules, lambda: None, self.metrics_path)
+            write_text.assert_not_called()
+
+        charm.update_alerts_rules(None, {}, lambda: None, self.metrics_path)
+        self.assertFalse(rule_file.exists())
+
 
 class TestLokiRules(TestAlertIngestion):
     def test_consumes_loki_rules(self):
@@ -149,9 +149,12 @@ class TestScrapeConfiguration(unittest.TestCase):
             "logs": {},
         }
 
-        config = yaml.safe_load(agent_container.pull("/etc/agent/agent.yaml").read())
+        config_text = agent_container.pull("/etc/agent/agent.yaml").read()
+        config = yaml.safe_load(config_text)
 
         self.assertEqual(DeepDiff(expected_config, config, ignore_order=True), {})
+        # The remote-write endpoints are shared between sections; they must not become aliases
+        self.assertNotIn("&id", config_text)
         self.assertEqual(self.harness.model.unit.status, ActiveStatus())
 
         # Test scale down
@@ -214,6 +217,36 @@ class TestScrapeConfiguration(unittest.TestCase):
             self.harness.model.unit.status, WaitingStatus("no related Prometheus remote-write")
         )
 
+    def test_unchanged_config_is_not_rewritten(self):
+        self.harness.charm._update_config(None)
+
+        # Without a stored fingerprint the config on disk is read and compared
+        self.harness.charm._stored.config_hash = None
+        with patch.object(GrafanaAgentK8sCharm, "write_file") as write_file, patch.object(
+            GrafanaAgentK8sCharm, "restart"
+        ) as restart:
+            self.harness.charm._update_config(None)
+            write_file.assert_not_called()
+            restart.assert_not_called()
+
+        # The comparison records the fingerprint, so the next update skips reading
+        with patch.object(GrafanaAgentK8sCharm, "read_file") as read_file:
+            self.harness.charm._update_config(None)
+            read_file.assert_not_called()
+
+    def test_unchanged_config_is_not_reread_across_hooks(self):
+        self.harness.charm._update_config(None)
+
+        with patch.object(GrafanaAgentK8sCharm, "read_file") as read_file:
+            self.harness.charm._update_config(None)
+            read_file.assert_not_called()
+
+        # The config is read again once the file changed behind our back
+        self.harness.charm._container.push("/etc/agent/agent.yaml", "{}")
+        self.harness.charm._update_config(None)
+        config = yaml.safe_load(self.harness.charm._container.pull("/etc/agent/agent.yaml").read())
+        self.assertIn("integrations", config)
+
     def test__cli_args(self):
         expected = "-config.file=/etc/agent/agent.yaml"
         self.assertEqual(self.harness.charm._cli_args(), expected)
@@ -261,9 +294,12 @@ class TestScrapeConfiguration(unittest.TestCase):
                 ]
             }
         }
+        loki_endpoints = self.harness.charm._loki_consumer.loki_endpoints
         self.assertEqual(
-            DeepDiff(expected, self.harness.charm._loki_config(), ignore_order=True), {}
+            DeepDiff(expected, self.harness.charm._loki_config(loki_endpoints), ignore_order=True),
+            {},
         )
 
         self.harness.remove_relation(rel_id)
-        self.assertEqual({"logs": {}}, self.harness.charm._loki_config())
+        loki_endpoints = self.harness.charm._loki_consumer.loki_endpoints
+        self.assertEqual({"logs": {}}, self.harness.charm._loki_config(loki_endpoints))